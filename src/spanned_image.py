@@ -3,6 +3,11 @@ import screeninfo
 from screeninfo import Monitor
 from dataclasses import dataclass
 from PIL import Image, ImageFilter
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import threading
+import tempfile
+import time
 import sys
 import os
 import configparser
@@ -12,6 +17,12 @@ import logging
 DEFAULT_DOT_PER_MM = 120 * 25.4
 MAX_CROP = 34
 ZERO = 'Zero'
+DEFAULT_INTERVAL = 300.0
+DEFAULT_LOOK_AHEAD = 3
+DEFAULT_WORKERS = 2
+LAYOUT_POLL_INTERVAL = 1.0
+HIGH_BIT_DEPTH_FORMATS = {'PNG': ('I;16',), 'TIFF': ('I', 'F')}
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.gif', '.tif', '.tiff', '.webp')
 
 
 @dataclass
@@ -21,6 +32,10 @@ class Configuration:
   crop: float = 0.0
   debug: bool = False
   center: str = ''
+  interval: float = DEFAULT_INTERVAL
+  look_ahead: int = DEFAULT_LOOK_AHEAD
+  workers: int = DEFAULT_WORKERS
+  high_bit_depth: bool = False
 
   __config = None
 
@@ -37,6 +52,15 @@ class Configuration:
       self.trim = _trim.upper() in ['TRUE', 'ON']
       _debug = str(self.__config.get('Config', 'debug', fallback=self.debug))
       self.debug = _debug.upper() in ['TRUE', 'ON']
+      _high_bit_depth = str(self.__config.get('Config', 'highBitDepth',
+                                              fallback=self.high_bit_depth))
+      self.high_bit_depth = _high_bit_depth.upper() in ['TRUE', 'ON']
+      _interval = float(self.__config.get('Playlist', 'interval', fallback=self.interval))
+      self.interval = _interval if _interval > 0 else DEFAULT_INTERVAL
+      _look_ahead = int(self.__config.get('Playlist', 'lookAhead', fallback=self.look_ahead))
+      self.look_ahead = max(_look_ahead, 1)
+      _workers = int(self.__config.get('Playlist', 'workers', fallback=self.workers))
+      self.workers = max(_workers, 1)
 
   def config(self):
     return self.__config
@@ -170,6 +194,50 @@ class DisplayInfo:
     return self.mm_y + self.mm_height
 
 
+def normalize_mode(image: Image, high_bit_depth: bool = False) -> Image:
+  mode = image.mode
+  if mode in ('RGB', 'L'):
+    return image
+  if mode.startswith('I') or mode == 'F':
+    if high_bit_depth:
+      return image if mode in ('I', 'F') else image.convert('I')
+    # scale samples down instead of letting convert() clip them,
+    # float samples are taken to be in the 0..1 range
+    if mode == 'F':
+      return image.point(lambda v: v * 255.0).convert('L')
+    return image.convert('I').point(lambda v: v * (1 / 256.0)).convert('L')
+  if mode in ('1', 'LA', 'La'):
+    return image.convert('L')
+  return image.convert('RGB')
+
+
+def fit_output_mode(image: Image, image_format: str) -> Image:
+  if image.mode not in ('I', 'F'):
+    return image
+  modes = HIGH_BIT_DEPTH_FORMATS.get(image_format, ())
+  if image.mode in modes:
+    return image
+  if 'I;16' in modes:
+    if image.mode == 'F':
+      image = image.point(lambda v: v * 65535.0).convert('I')
+    return image.convert('I;16')
+  return normalize_mode(image)
+
+
+def output_format(output_file) -> str:
+  suffix = os.path.splitext(output_file)[1].lower()
+  return Image.registered_extensions().get(suffix, 'PNG')
+
+
+def luminance(image: Image) -> Image:
+  # a normalized grayscale image is used as is, colour images need their own conversion
+  if image.mode == 'L':
+    return image
+  if image.mode in ('I', 'F'):
+    return normalize_mode(image)
+  return image.convert('L')
+
+
 @dataclass
 class Canvas:
   displays: {str: DisplayInfo}
@@ -183,6 +251,7 @@ class Canvas:
   __padding: bool = False
   __crop: float = 0.0
   __trim: bool = False
+  __high_bit_depth: bool = False
   __canvas_center: Position = None
   __offset: Position = None
 
@@ -202,6 +271,7 @@ class Canvas:
       self.__padding = config.padding
       self.__crop = config.crop
       self.__trim = config.trim
+      self.__high_bit_depth = config.high_bit_depth
       self.__offset = self.__set_offset(config)
 
   def display_size(self):
@@ -214,9 +284,9 @@ class Canvas:
     return self.__image
 
   def paint(self) -> Image:
-    target = Image.new('RGB', self.display_size(), 'black')
     if self.__image is None:
-      return target
+      return Image.new('RGB', self.display_size(), 'black')
+    target = Image.new(self.__image.mode, self.display_size(), 0)
 
     assert self.__fit_rect is not None
     source_image = self.__image
@@ -236,6 +306,7 @@ class Canvas:
     return target
 
   def __prepare_image(self, image):
+    image = normalize_mode(image, self.__high_bit_depth)
     image_rect = Rect.of(image)
     image_ratio = image_rect.vh_ratio()
     if self.__canvas_ratio == image_ratio:
@@ -281,8 +352,12 @@ class Canvas:
 
   def __pad_image(self, image: Image, pad_rect: Rect, image_ratio: float) -> Image:
     image_rect = Rect.of(image)
-    from PIL import ImageFilter
-    source = image.filter(ImageFilter.BoxBlur(radius=16))
+    if image.mode in ('I', 'F'):
+      # BoxBlur only handles 8-bit modes, blur by scaling down and up again
+      source = image.resize((max(image.width // 16, 1), max(image.height // 16, 1)),
+                            Image.Resampling.BILINEAR).resize(image.size, Image.Resampling.BILINEAR)
+    else:
+      source = image.filter(ImageFilter.BoxBlur(radius=16))
     x = 0
     y = 0
     if image_ratio > self.__canvas_ratio:
@@ -310,7 +385,7 @@ class Canvas:
     image_rect = Rect.of(image)
     box_rect: Rect
     if self.__trim:
-      img = image.convert('L').filter(ImageFilter.BoxBlur(radius=5))
+      img = luminance(image).filter(ImageFilter.BoxBlur(radius=5))
       edge = img.filter(ImageFilter.Kernel((3, 3), (-1, -1, -1, -1, 8, -1, -1, -1, -1), 1.0, -30))
       edge = edge.crop(image_rect.shrink().box())
       box = Image.Image.getbbox(edge)
@@ -338,7 +413,7 @@ class Canvas:
     return image_rect
 
 
-def build_displays(config: Configuration):
+def build_displays(config: Configuration, verbose: bool = True):
   displays = {}
   for m in screeninfo.get_monitors():
     display = DisplayInfo(m)
@@ -347,19 +422,21 @@ def build_displays(config: Configuration):
   for display in displays.values():
     read_horz_offset_from_config(config, display, displays)
     read_vert_offset_from_config(config, display, displays)
-  return normalize_displays(displays)
+  return normalize_displays(displays, verbose)
 
 
-def normalize_displays(displays: {str: DisplayInfo}):
-  for display in displays.values():
-    logging.debug('display initial: %s', str(display))
+def normalize_displays(displays: {str: DisplayInfo}, verbose: bool = True):
+  if verbose:
+    for display in displays.values():
+      logging.debug('display initial: %s', str(display))
   h_sort = sorted(displays.values(), key=get_display_x)
   v_sort = sorted(displays.values(), key=get_display_y)
   init_horizontal_references(displays, h_sort)
   init_vertical_references(displays, v_sort)
   normalize_positions(displays)
-  for display in displays.values():
-    logging.debug('display after adjust: %s', str(display))
+  if verbose:
+    for display in displays.values():
+      logging.debug('display after adjust: %s', str(display))
   return displays
 
 
@@ -591,18 +668,217 @@ def read_image(input_file) -> Image:
   return _image
 
 
-def spanned_image(config, input_file, output_file):
-  displays = build_displays(config)
+def render_image(displays: {str: DisplayInfo}, config, input_file) -> Image:
   canvas = Canvas(displays, config)
   image = read_image(input_file)
   canvas.set_image(image)
-  result = canvas.paint()
+  return canvas.paint()
+
+
+def layout_signature(displays: {str: DisplayInfo}):
+  return tuple(sorted((d.name, d.x, d.y, d.width, d.height,
+                       d.mm_x, d.mm_y, d.mm_width, d.mm_height) for d in displays.values()))
+
+
+def load_playlist(source) -> [str]:
+  if os.path.isdir(source):
+    names = sorted(os.listdir(source))
+    return [os.path.join(source, n) for n in names
+            if os.path.splitext(n)[1].lower() in IMAGE_EXTENSIONS]
+  base = os.path.dirname(source)
+  files = []
+  with open(source, 'r') as f:
+    for line in f:
+      line = line.strip()
+      if line and not line.startswith('#'):
+        files.append(os.path.join(base, os.path.expanduser(line)))
+  return files
+
+
+@dataclass
+class PlaylistMetrics:
+  queue_depth: int = 0
+  ready: int = 0
+  rendered: int = 0
+  published: int = 0
+  discarded: int = 0
+  render_lag: float = 0.0
+  max_render_lag: float = 0.0
+
+
+@dataclass
+class PlaylistItem:
+  index: int
+  input_file: str
+  future: object = None
+
+
+class Playlist:
+  """Rotates wallpapers, keeping the next few outputs rendered and encoded in the background."""
+
+  def __init__(self, config: Configuration, files: [str], output_file: str):
+    assert files
+    self.config = config
+    self.files = files
+    self.output_file = output_file
+    self.__queue = deque()
+    self.__next_index = 0
+    self.__displays = None
+    self.__signature = None
+    self.__metrics = PlaylistMetrics()
+    self.__lock = threading.Lock()
+    self.__stop = threading.Event()
+    _umask = os.umask(0)
+    os.umask(_umask)
+    self.__file_mode = 0o666 & ~_umask
+    self.__executor = ThreadPoolExecutor(max_workers=config.workers,
+                                         thread_name_prefix='spanned-image')
+
+  def metrics(self) -> PlaylistMetrics:
+    with self.__lock:
+      self.__metrics.queue_depth = len(self.__queue)
+      self.__metrics.ready = len([i for i in self.__queue if i.future.done()])
+      return PlaylistMetrics(**vars(self.__metrics))
+
+  def stop(self):
+    self.__stop.set()
+
+  def run(self, count: int = None):
+    try:
+      due = time.monotonic()
+      published = 0
+      while not self.__stop.is_set() and (count is None or published < count):
+        self.__check_layout()
+        self.__fill()
+        if self.__publish(due):
+          published += 1
+          if count is not None and published >= count:
+            break
+        due += self.config.interval
+        now = time.monotonic()
+        if due < now:
+          # skip the missed slots instead of publishing them all at once
+          due = now + self.config.interval
+        self.__fill()
+        self.__wait_until(due)
+    finally:
+      self.close()
+
+  def close(self):
+    self.__discard_all()
+    self.__executor.shutdown(wait=True)
+    metrics = self.metrics()
+    logging.info('playlist stopped, published %d, rendered %d, discarded %d, max render lag %.3fs',
+                 metrics.published, metrics.rendered, metrics.discarded, metrics.max_render_lag)
+
+  def __wait_until(self, due: float):
+    while not self.__stop.is_set():
+      remaining = due - time.monotonic()
+      if remaining <= 0:
+        return
+      self.__stop.wait(min(remaining, LAYOUT_POLL_INTERVAL))
+      self.__check_layout()
+      self.__fill()
+
+  def __check_layout(self):
+    try:
+      displays = build_displays(self.config, verbose=False)
+    except Exception as e:
+      logging.error('reading display layout with error %s', e)
+      return
+    signature = layout_signature(displays)
+    if signature != self.__signature:
+      for display in displays.values():
+        logging.debug('display layout: %s', str(display))
+      if self.__signature is not None:
+        logging.info('display layout changed, re-rendering %d queued item(s)', len(self.__queue))
+        self.__next_index = self.__queue[0].index if self.__queue else self.__next_index
+        self.__discard_all()
+      self.__displays = displays
+      self.__signature = signature
+
+  def __fill(self):
+    if self.__displays is None:
+      return
+    while len(self.__queue) < self.config.look_ahead:
+      index = self.__next_index
+      item = PlaylistItem(index, self.files[index % len(self.files)])
+      item.future = self.__executor.submit(self.__render, self.__displays, item.input_file)
+      with self.__lock:
+        self.__queue.append(item)
+      self.__next_index += 1
+
+  def __render(self, displays, input_file) -> str:
+    result = render_image(displays, self.config, input_file)
+    suffix = os.path.splitext(self.output_file)[1]
+    output_dir = os.path.dirname(os.path.abspath(self.output_file))
+    (fd, rendered_file) = tempfile.mkstemp(prefix='.spanned-image-', suffix=suffix, dir=output_dir)
+    try:
+      image_format = output_format(self.output_file)
+      with os.fdopen(fd, 'wb') as f:
+        fit_output_mode(result, image_format).save(f, format=image_format)
+      os.chmod(rendered_file, self.__file_mode)
+    except Exception:
+      os.remove(rendered_file)
+      raise
+    with self.__lock:
+      self.__metrics.rendered += 1
+    return rendered_file
+
+  def __publish(self, due: float) -> bool:
+    rendered_file = None
+    for _ in range(len(self.files)):
+      if not self.__queue:
+        return False
+      with self.__lock:
+        item = self.__queue.popleft()
+      try:
+        rendered_file = item.future.result()
+        break
+      except Exception as e:
+        logging.error('rendering %s with error %s', item.input_file, e)
+        self.__fill()
+    if rendered_file is None:
+      return False
+    os.replace(rendered_file, self.output_file)
+    lag = max(time.monotonic() - due, 0.0)
+    with self.__lock:
+      self.__metrics.published += 1
+      self.__metrics.render_lag = lag
+      self.__metrics.max_render_lag = max(self.__metrics.max_render_lag, lag)
+    metrics = self.metrics()
+    logging.info('published %s, queue depth %d (%d ready), render lag %.3fs',
+                 item.input_file, metrics.queue_depth, metrics.ready, metrics.render_lag)
+    return True
+
+  def __discard_all(self):
+    with self.__lock:
+      items = list(self.__queue)
+      self.__queue.clear()
+      self.__metrics.discarded += len(items)
+    for item in items:
+      if not item.future.cancel():
+        item.future.add_done_callback(Playlist.__remove_rendered)
+
+  @staticmethod
+  def __remove_rendered(future):
+    if future.cancelled() or future.exception() is not None:
+      return
+    try:
+      os.remove(future.result())
+    except OSError:
+      pass
+
+
+def spanned_image(config, input_file, output_file):
+  displays = build_displays(config)
+  result = render_image(displays, config, input_file)
   logging.debug('saving image: %s', output_file)
   try:
-    result.save(output_file)
+    fit_output_mode(result, output_format(output_file)).save(output_file)
     config = Configuration()
     if config.debug:
-      result.save('/tmp/spanned-image.png')
+      fit_output_mode(result, 'PNG').save('/tmp/spanned-image.png')
   except Exception as e:
     logging.error("saving writing %s with error %s", output_file, e)
 
@@ -614,6 +890,7 @@ def print_monitors():
 
 def print_usage():
   print('Usage: {0} <input file> <output file>'.format(sys.argv[0]))
+  print('       {0} --playlist <directory or list file> <output file>'.format(sys.argv[0]))
 
 
 def main():
@@ -623,7 +900,18 @@ def main():
   else:
     logging.basicConfig(filename='/tmp/spanned_image.log', level=logging.INFO, format='')
   logging.info('parameters: %s', sys.argv)
-  if len(sys.argv) != 3:
+  if len(sys.argv) == 4 and sys.argv[1] == '--playlist':
+    try:
+      files = load_playlist(sys.argv[2])
+      if not files:
+        logging.error('no image found in playlist %s', sys.argv[2])
+        return
+      Playlist(config, files, sys.argv[3]).run()
+    except KeyboardInterrupt:
+      pass
+    except Exception as e:
+      logging.error("Exception %s", e)
+  elif len(sys.argv) != 3:
     print_usage()
     print_monitors()
     if len(sys.argv) == 2:
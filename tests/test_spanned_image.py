@@ -1,9 +1,38 @@
 import unittest
+import os
+import tempfile
+import time
 from unittest import TestCase
+from unittest.mock import patch
 
+from PIL import Image
 from screeninfo import Monitor
 
-from src.spanned_image import DisplayInfo, normalize_displays, find_display_left
+from src import spanned_image
+from src.spanned_image import DisplayInfo, normalize_displays, find_display_left, \
+  load_playlist, layout_signature, normalize_mode, Configuration, Playlist, Canvas, \
+  fit_output_mode
+
+
+def build_layout(count):
+  monitors = {}
+  for i in range(count):
+    name = 'm{0}'.format(i)
+    monitors[name] = DisplayInfo(
+        Monitor(name=name, x=i * 40, y=0, width=40, height=30, width_mm=400, height_mm=300))
+  return normalize_displays(monitors)
+
+
+def playlist_config():
+  config = Configuration()
+  config.interval = 0.05
+  config.look_ahead = 2
+  config.workers = 2
+  config.padding = False
+  config.crop = 0.0
+  config.trim = False
+  config.high_bit_depth = False
+  return config
 
 
 class Test(TestCase):
@@ -42,6 +71,174 @@ class Test(TestCase):
     assert monitors['c'].mm_x == 18240
     print(str(monitors))
 
+  @staticmethod
+  def test_load_playlist():
+    with tempfile.TemporaryDirectory() as directory:
+      for name in ['b.png', 'a.jpg', 'notes.txt']:
+        open(os.path.join(directory, name), 'w').close()
+      assert load_playlist(directory) == [os.path.join(directory, 'a.jpg'),
+                                          os.path.join(directory, 'b.png')]
+
+      list_file = os.path.join(directory, 'list.txt')
+      with open(list_file, 'w') as f:
+        f.write('# comment\nb.png\n\na.jpg\n')
+      assert load_playlist(list_file) == [os.path.join(directory, 'b.png'),
+                                          os.path.join(directory, 'a.jpg')]
+
+  @staticmethod
+  def test_layout_signature():
+    monitors = {
+        'a': DisplayInfo(
+            Monitor(name='a', x=0, y=0, width=800, height=600, width_mm=8000, height_mm=6000)),
+    }
+    signature = layout_signature(monitors)
+    monitors['a'].mm_x = 10
+    assert layout_signature(monitors) != signature
+
+  @staticmethod
+  def test_normalize_mode():
+    assert normalize_mode(Image.new('P', (4, 4))).mode == 'RGB'
+    assert normalize_mode(Image.new('CMYK', (4, 4))).mode == 'RGB'
+    assert normalize_mode(Image.new('LA', (4, 4))).mode == 'L'
+
+    deep = Image.new('I;16', (4, 4), 0x8000)
+    assert normalize_mode(deep).getpixel((0, 0)) == 0x80
+    high = normalize_mode(deep, high_bit_depth=True)
+    assert high.mode == 'I'
+    assert high.getpixel((0, 0)) == 0x8000
+
+    assert normalize_mode(Image.new('F', (4, 4), 0.5)).getpixel((0, 0)) == 127
+
+  @staticmethod
+  def test_canvas_output_mode():
+    for mode in ['P', 'CMYK']:
+      canvas = Canvas(build_layout(2), playlist_config())
+      canvas.set_image(Image.new(mode, (160, 60)))
+      result = canvas.paint()
+      assert result.mode == 'RGB'
+      assert result.size == (80, 30)
+
+    config = playlist_config()
+    config.high_bit_depth = True
+    config.padding = True
+    canvas = Canvas(build_layout(2), config)
+    canvas.set_image(Image.new('I;16', (100, 100), 0x8000))
+    result = canvas.paint()
+    assert result.mode == 'I'
+    assert result.getpixel((40, 15)) == 0x8000
+    assert fit_output_mode(result, 'PNG').mode == 'I;16'
+    assert fit_output_mode(result, 'JPEG').getpixel((40, 15)) == 0x80
+
+    canvas = Canvas(build_layout(2), config)
+    canvas.set_image(Image.new('F', (160, 60), 0.5))
+    result = canvas.paint()
+    assert result.mode == 'F'
+    assert fit_output_mode(result, 'TIFF').mode == 'F'
+    assert fit_output_mode(result, 'PNG').getpixel((40, 15)) == 32767
+    assert fit_output_mode(result, 'JPEG').getpixel((40, 15)) == 127
+
+    canvas = Canvas(build_layout(2), playlist_config())
+    canvas.set_image(Image.new('F', (160, 60), 0.5))
+    result = canvas.paint()
+    assert result.mode == 'L'
+    assert result.getpixel((40, 15)) == 127
+
+  @staticmethod
+  def test_playlist_rerenders_on_layout_change():
+    calls = []
+
+    def layouts(_config, verbose=True):
+      calls.append(True)
+      if len(calls) == 2:
+        raise RuntimeError('no monitors')
+      return build_layout(1 if len(calls) == 1 else 2)
+
+    with tempfile.TemporaryDirectory() as directory:
+      files = []
+      for i in range(3):
+        files.append(os.path.join(directory, 'source{0}.png'.format(i)))
+        Image.new('RGB', (80, 60), (i * 80, 0, 0)).save(files[-1])
+      output_file = os.path.join(directory, 'output.png')
+      config = playlist_config()
+      config.interval = 0.2
+      playlist = Playlist(config, files, output_file)
+      with patch('src.spanned_image.build_displays', side_effect=layouts), \
+           patch('src.spanned_image.LAYOUT_POLL_INTERVAL', 0.02):
+        playlist.run(count=2)
+
+      metrics = playlist.metrics()
+      # the layout is polled while waiting, and a failed poll is retried
+      assert len(calls) > 3
+      assert metrics.published == 2
+      assert 1 <= metrics.discarded <= 2 * playlist.config.look_ahead
+      assert metrics.queue_depth == 0
+      with Image.open(output_file) as output:
+        assert output.size == (80, 30)
+      umask = os.umask(0)
+      os.umask(umask)
+      assert os.stat(output_file).st_mode & 0o777 == 0o666 & ~umask
+      assert not [n for n in os.listdir(directory) if n.startswith('.spanned-image-')]
+
+  @staticmethod
+  def test_playlist_skips_failed_render():
+    with tempfile.TemporaryDirectory() as directory:
+      source = os.path.join(directory, 'source.png')
+      Image.new('RGB', (80, 60), 'red').save(source)
+      output_file = os.path.join(directory, 'output.png')
+      files = [os.path.join(directory, 'missing.png'), source]
+      config = playlist_config()
+      config.interval = 1.0
+      playlist = Playlist(config, files, output_file)
+      started = time.monotonic()
+      with patch('src.spanned_image.build_displays', return_value=build_layout(1)):
+        playlist.run(count=1)
+
+      # the failed item is replaced within the same slot
+      assert time.monotonic() - started < 0.5
+
+      metrics = playlist.metrics()
+      assert metrics.published == 1
+      assert metrics.queue_depth == 0
+      with Image.open(output_file) as output:
+        assert output.getpixel((0, 0)) == (255, 0, 0)
+      assert not [n for n in os.listdir(directory) if n.startswith('.spanned-image-')]
+
+  @staticmethod
+  def test_playlist_skips_missed_slots():
+    render_image = spanned_image.render_image
+    renders = []
+    published = []
+
+    def slow_render(*args):
+      renders.append(True)
+      if len(renders) == 1:
+        time.sleep(0.5)
+      return render_image(*args)
+
+    replace = os.replace
+
+    def timed_replace(*args):
+      published.append(time.monotonic())
+      replace(*args)
+
+    with tempfile.TemporaryDirectory() as directory:
+      source = os.path.join(directory, 'source.png')
+      Image.new('RGB', (80, 60), 'red').save(source)
+      config = playlist_config()
+      config.interval = 0.1
+      config.workers = 1
+      config.look_ahead = 1
+      playlist = Playlist(config, [source], os.path.join(directory, 'output.png'))
+      with patch('src.spanned_image.build_displays', return_value=build_layout(1)), \
+           patch('src.spanned_image.render_image', side_effect=slow_render), \
+           patch('src.spanned_image.os.replace', side_effect=timed_replace):
+        playlist.run(count=4)
+
+      assert len(published) == 4
+      for previous, current in zip(published, published[1:]):
+        assert current - previous > config.interval * 0.5
+      assert playlist.metrics().max_render_lag >= 0.4
+
 
 if __name__ == '__main__':
   unittest.main()